@@ -1,33 +1,75 @@
 import argparse
 import socket
-from datetime import datetime
+import time
+
+#: Maximum number of bytes received with a single call
+RECV_SIZE = 65536
+#: Size of the capture buffer, received data is collected there and written to the file when it is full
+CAPTURE_BUFFER_SIZE = 1 << 20
+#: Seconds after which captured data are written to the file even if the capture buffer is not full
+FLUSH_INTERVAL = 5
+
+
+def write_all(f, data: memoryview):
+    # a raw unbuffered file may write less than requested, write until all data are in the file
+    while data:
+        written = f.write(data)
+        data = data[written:]
 
 
 def main():
     # host = 'HF-A21.fritz.box'
-    buffer = bytearray(2048)
+    buffer = bytearray(CAPTURE_BUFFER_SIZE)
 
     parser = argparse.ArgumentParser(
         prog='rct-dump',
         description='Listen on the RCT socket and dump received frames to a file',
     )
     parser.add_argument('--host', help='host-name or IP of device', required=True)
-    parser.add_argument('--port', default=8899, help='Port to connect to, default 8899')
+    parser.add_argument('--port', default=8899, type=int, help='Port to connect to, default 8899')
     parser.add_argument('-f', '--outfile', help='file name for output', required=True)
+    parser.add_argument('--hex', help='print received bytes as hex dump', action='store_true')
     parsed = parser.parse_args()
 
     print(f'Capturing packets now to file {parsed.outfile}.')
     print('Press Ctrl-C/Cmd-C to stop.')
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-        with open(parsed.outfile, 'wb') as f:
+        # unbuffered file, packets are received directly into the capture buffer and written from there
+        with open(parsed.outfile, 'wb', buffering=0) as f:
             sock.connect((parsed.host, parsed.port))
-            while True:
-                bytes_read = sock.recv_into(buffer, len(buffer))
-                now = datetime.now()
-                print(f'{now.strftime("%H:%M:%S")}: read bytes from socket: {bytes_read}')
-                mv = memoryview(buffer)[0:bytes_read]
-                print(f'Buffer length: {bytes_read}: {mv.hex(" ")}')
-                f.write(mv)
+            sock.settimeout(FLUSH_INTERVAL)  # wake up to write pending data when the device is silent
+            buffer_view = memoryview(buffer)
+            filled = 0
+            last_second = 0
+            last_flush = int(time.time())
+            time_str = ''
+            try:
+                while True:
+                    try:
+                        bytes_read = sock.recv_into(buffer_view[filled:], RECV_SIZE)
+                    except TimeoutError:
+                        write_all(f, buffer_view[0:filled])
+                        filled = 0
+                        last_flush = int(time.time())
+                        continue
+                    if bytes_read == 0:
+                        print('Connection closed by device.')
+                        break
+                    now = int(time.time())
+                    if now != last_second:  # format the time stamp only once per second
+                        last_second = now
+                        time_str = time.strftime('%H:%M:%S', time.localtime(now))
+                    print(f'{time_str}: read bytes from socket: {bytes_read}')
+                    if parsed.hex:
+                        print(f'Buffer length: {bytes_read}: {buffer_view[filled:filled + bytes_read].hex(" ")}')
+                    filled += bytes_read
+                    # write when the buffer is nearly full, but keep at most FLUSH_INTERVAL seconds in memory
+                    if len(buffer) - filled < RECV_SIZE or now - last_flush >= FLUSH_INTERVAL:
+                        write_all(f, buffer_view[0:filled])
+                        filled = 0
+                        last_flush = now
+            finally:
+                write_all(f, buffer_view[0:filled])
 
 
 if __name__ == '__main__':
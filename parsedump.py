@@ -1,11 +1,63 @@
 import argparse
 import logging
+import mmap
+import os
+import sys
+import traceback
+from typing import Any, Callable
 import rct_parser
-from rctclient.types import DataType
-from rctclient.utils import decode_value  # , encode_value
-from rctclient.registry import REGISTRY as Registry
+from rctclient.registry import REGISTRY as Registry, ObjectInfo
 from rctclient.exceptions import InvalidCommand
 
+#: Size of the buffer for the parsing results written to stdout
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+
+def _make_line_template(oid: ObjectInfo) -> str:
+    # the name and type of an OID never change, only counter, value and position are filled in per frame
+    name = oid.name.replace('{', '{{').replace('}', '}}')
+    return f'{{:04}}:: OID: {name}, Value: {{}}, type: {oid.response_data_type} found at: {{}}'
+
+
+#: Maps object ids to the payload decoder and output line template, built once so the main loop does a single lookup
+OID_TABLE: dict[int, tuple[Callable[[bytes], Any], str]] = {
+    oid.object_id: (rct_parser.make_decoder(oid.response_data_type), _make_line_template(oid))
+    for oid in Registry.all()
+}
+
+
+def print_frames(mv: memoryview):
+    finished = False
+    parser = rct_parser.FrameParser()
+    counter = 0
+
+    # write the per-frame lines through a large buffer instead of flushing stdout for each of them
+    sys.stdout.flush()
+    with open(sys.stdout.fileno(), 'w', buffering=OUTPUT_BUFFER_SIZE, closefd=False) as out:
+        while not finished:
+            pos = parser.current_pos
+            try:
+                frame = parser.parse(mv)
+                finished = not parser.complete_frame
+                if frame:
+                    if not frame.crc_ok:
+                        print('Error: wrong CRC sum', file=out)
+                    decode, line = OID_TABLE[frame.oid]
+                    print(line.format(counter, decode(frame.payload), pos), file=out)
+                    counter += 1
+
+            except InvalidCommand as ex:
+                # the parser already continues behind the invalid start token
+                print(f'Exception at {parser.current_pos - 1}: {ex}', file=out)
+                counter = 0
+            except Exception as ex:
+                # the locals of the failed calls still hold views on the mapped file, closing it would fail
+                # with a BufferError that hides this exception
+                traceback.clear_frames(ex.__traceback__)
+                raise
+
+        print(f'Parsing finished at pos: {parser.current_pos} from {len(mv)}', file=out)
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -21,38 +73,19 @@ def main():
         logging.basicConfig(level=logging.DEBUG)
     else:
         logging.basicConfig(level=logging.WARN)
+        logging.disable(logging.INFO)  # drop debug and info records before any logger is asked
 
+    # map the capture file instead of reading it, the OS pages it in sequentially while parsing
     with open(parsed.infile, 'rb') as f:
-        frame_buffer = f.read()
-    print(f'read {len(frame_buffer)} bytes')
-    finished = False
-    mv = memoryview(frame_buffer)
-    parser = rct_parser.FrameParser()
-    counter = 0
-
-    while not finished:
-        pos = parser.current_pos
-        try:
-            frame = parser.parse(mv)
-            finished = not parser.complete_frame
-            if frame:
-                if not frame.crc_ok:
-                    print('Error: wrong CRC sum')
-                oid = Registry.get_by_id(frame.oid)
-                ftype = oid.response_data_type
-                if ftype != DataType.UNKNOWN:
-                    value = decode_value(ftype, frame.payload)
-                else:
-                    value = frame.payload.hex(' ')
-                print(f'{counter:04}:: OID: {oid.name}, Value: {value}, type: {ftype} found at: {pos}')
-                counter += 1
-
-        except InvalidCommand as ex:
-            print(f'Exception at {parser.current_pos}: {ex}')
-            parser.current_pos += 1
-            counter = 0
-
-    print(f'Parsing finished at pos: {parser.current_pos} from {len(mv)}')
+        if os.fstat(f.fileno()).st_size == 0:
+            print('read 0 bytes')
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as frame_buffer:
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                frame_buffer.madvise(mmap.MADV_SEQUENTIAL)
+            print(f'read {len(frame_buffer)} bytes')
+            with memoryview(frame_buffer) as mv:
+                print_frames(mv)
 
 
 if __name__ == '__main__':
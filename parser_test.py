@@ -1,9 +1,12 @@
+import functools
 import logging
+import pytest
 import rct_parser
 import rctclient.frame
 from rctclient.types import Command, FrameType, DataType
 from rctclient.registry import REGISTRY as Registry
-from rctclient.utils import decode_value, encode_value
+from rctclient.utils import decode_value, encode_value, CRC16
+from rctclient.exceptions import InvalidCommand
 
 LOREM = '''Lorem ipsum dolor sit amet, consetetur sadipscing elitr, sed
     diam nonumy eirmod tempor invidunt ut labore et dolore magna aliquyam
@@ -17,7 +20,15 @@ LOREM = '''Lorem ipsum dolor sit amet, consetetur sadipscing elitr, sed
 '''
 
 
+@functools.lru_cache(maxsize=256)
+def make_frame_bytes(command: Command, frame_id: int, payload: bytes, address: int, frame_type: FrameType) -> bytes:
+    # the encoded frame only depends on these values, so every combination is built once by rctclient
+    return rctclient.frame.make_frame(command, frame_id, payload, address, frame_type)
+
+
 class Frame:
+    __slots__ = ('frame_id', 'address', 'frame_type', 'value', 'command', 'dataType', 'payload')
+
     def __init__(
         self,
         command: Command = Command.RESPONSE,
@@ -36,8 +47,7 @@ class Frame:
         self.payload = encode_value(dataType, value)
 
     def make_frame(self) -> bytes:
-        return rctclient.frame.make_frame(self.command, self.frame_id, self.payload, self.address,
-            self.frame_type)
+        return make_frame_bytes(self.command, self.frame_id, self.payload, self.address, self.frame_type)
 
 
 def check_response(frame: Frame, frame_bytes: bytes = None) -> rct_parser.FrameParser:
@@ -75,6 +85,12 @@ def test_parser_escaped_int():
     check_response(frame)
 
 
+def test_parser_consecutive_escapes():
+    intValue = 0x2D2B2D2D
+    frame = Frame(value=intValue)
+    check_response(frame)
+
+
 def test_parser_leading_bytes():
     frame = Frame()
     test_frame = bytes.fromhex('00 00 00 00') + frame.make_frame()
@@ -117,6 +133,24 @@ def test_parser_incomplete_frame():
     assert value == frame.value
 
 
+def test_parser_incomplete_frame_after_garbage():
+    frame = Frame()
+    garbage = b'\x00\x01\x02'
+    buffer = frame.make_frame()
+    mid = int(len(buffer) / 2)
+    buffer1 = bytearray(garbage + buffer[:mid])
+    parser = rct_parser.FrameParser()
+    assert parser.parse(memoryview(buffer1)) is None
+    assert not parser.complete_frame
+    # the garbage is not scanned again when the rest of the frame arrives
+    assert parser.current_pos == len(garbage)
+    buffer1 += buffer[mid:]
+    res_frame = parser.parse(memoryview(buffer1))
+    assert parser.complete_frame
+    assert decode_value(frame.dataType, res_frame.payload) == frame.value
+    assert parser.current_pos == len(buffer1)
+
+
 def test_parser_two_frames():
     frame = Frame()
     buffer = frame.make_frame()
@@ -275,6 +309,21 @@ def test_parser_end_of_block():
     assert result_frame is None
 
 
+def test_parser_invalid_command_position(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # parser writes a state log file on invalid commands
+    frame = Frame()
+    test_frame = bytes.fromhex('00 00 00 2B 00 11 11') + frame.make_frame()
+    parser = rct_parser.FrameParser()
+    mv = memoryview(test_frame)
+    with pytest.raises(InvalidCommand):
+        parser.parse(mv)
+    assert parser.current_pos == 4  # behind the invalid start token
+    res_frame = parser.parse(mv)
+    assert parser.complete_frame
+    assert res_frame.crc_ok
+    assert decode_value(frame.dataType, res_frame.payload) == frame.value
+
+
 def test_escaped_check_sum():
     test_frame = bytes.fromhex('2B 05 06 36 23 D8 2A 00 02 D0 2D 2B')
     parser = rct_parser.FrameParser()
@@ -288,6 +337,39 @@ def test_escaped_check_sum():
     assert value == 2
 
 
+def test_parser_position_after_multiple_escapes():
+    frame1 = Frame(value=0x2D2B2D2D)
+    frame2 = Frame(value=789)
+    buffer1 = frame1.make_frame()
+    test_bytes = buffer1 + frame2.make_frame()
+    parser = check_response(frame1, test_bytes)
+    assert parser.current_pos == len(buffer1)
+    res_frame = parser.parse(memoryview(test_bytes))
+    assert parser.complete_frame
+    assert decode_value(frame2.dataType, res_frame.payload) == frame2.value
+
+
+def test_parser_frame_after_escaped_check_sum():
+    # check sum ends with an escaped '-', the following start token must not be taken as escaped
+    first = bytes.fromhex('2B 05 0C 7D 83 9A E6 61 62 63 2D 2D 2D 2B 64 65 66 8F 2D 2D')
+    frame = Frame()
+    test_bytes = first + frame.make_frame()
+    parser = rct_parser.FrameParser()
+    res_frame = parser.parse(test_bytes)
+    assert res_frame.crc_ok
+    assert res_frame.crc16 == 0x8f2d
+    assert parser.current_pos == len(first)
+    res_frame = parser.parse(test_bytes)
+    assert parser.complete_frame
+    assert res_frame.oid == frame.frame_id
+
+
+def test_crc16_matches_rctclient():
+    for data in (b'', b'\x05', bytes.fromhex('05 06 36 23 D8 2A 00 02'), LOREM.encode('utf-8')):
+        assert rct_parser.crc16_ccitt(data) == CRC16(data)
+        assert rct_parser.crc16_ccitt(memoryview(data)) == CRC16(data)
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
     #  test_parser_incomplete_frame()
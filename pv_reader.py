@@ -1,19 +1,19 @@
 import argparse
 import logging
+import math
 import time
 import traceback
 import signal
 import sys
-from datetime import datetime, timedelta
+from typing import Any, Callable, NamedTuple, Optional
 
 from rctclient.registry import REGISTRY as R
 from rctclient.types import DataType
 from rctclient.utils import decode_value
 from rctclient.exceptions import ReceiveFrameError
 from rct_reader import RctReader
-from rct_parser import ResponseFrame
-from influxdb_client import InfluxDBClient, Point, WriteApi
-from influxdb_client.client.write_api import SYNCHRONOUS
+from rct_parser import FIXED_SIZE_TYPES, ResponseFrame, make_decoder
+from influxdb_client import InfluxDBClient, WriteApi, WriteOptions, WritePrecision
 import urllib3
 
 # https://realpython.com/async-io-python/
@@ -21,29 +21,76 @@ import urllib3
 log = logging.getLogger(__name__)
 
 
-def read_oid_set(reader: RctReader, oid_set) -> dict[str, any]:
-    readings: dict[str, any] = {}
-    frames = reader.read_frames(oid_set)
-    for frame in frames:
+class OidPlanEntry(NamedTuple):
+    '''
+    Registry information of an OID to read, resolved once before reading periodically.
+    '''
+    name: str
+    unit: str
+    field: str  # field name in InfluxDB
+    decode: Callable[[bytes], Any]
+
+
+def make_reading_decoder(data_type: DataType) -> Callable[[bytes], Any]:
+    '''
+    Returns the decoder for the readings of an OID, float values are rounded to one decimal. Payloads of the
+    other variable size types that can not be decoded are returned as hex string.
+    '''
+    decode = make_decoder(data_type)
+    if data_type == DataType.FLOAT:
+        return lambda payload: round(decode(payload), 1)
+    if data_type in FIXED_SIZE_TYPES or data_type == DataType.UNKNOWN:
+        return decode
+
+    def decode_or_hex(payload: bytes) -> Any:
+        try:
+            return decode(payload)
+        except ValueError:
+            return payload.hex(' ')
+    return decode_or_hex
+
+
+#: Plans built by build_oid_plan, keyed by the OID names and field names they were built from
+_plan_cache: dict[tuple[tuple[str, str], ...], tuple[OidPlanEntry, ...]] = {}
+
+
+def build_oid_plan(readings: dict[str, str]) -> tuple[OidPlanEntry, ...]:
+    key = tuple(readings.items())
+    if key in _plan_cache:
+        return _plan_cache[key]
+    plan = []
+    for name, field in readings.items():
+        oid = R.get_by_name(name)
+        plan.append(OidPlanEntry(name, oid.unit if oid.unit else '', field,
+                                 make_reading_decoder(oid.response_data_type)))
+    # plans are shared by all callers, keep them immutable
+    _plan_cache[key] = tuple(plan)
+    return _plan_cache[key]
+
+
+def read_oid_set(
+    reader: RctReader,
+    plan: tuple[OidPlanEntry, ...],
+    readings: Optional[list[Any]] = None,
+) -> list[Any]:
+    '''
+    Reads all OIDs of the plan. The value of each plan entry is stored at the same index of the result,
+    None if it could not be read. If a list is passed as readings it is filled and returned instead of a new one.
+    '''
+    if readings is None:
+        readings = [None] * len(plan)
+    frames = reader.read_frames([entry.name for entry in plan])
+    for i, (entry, frame) in enumerate(zip(plan, frames)):
         value = None
         if frame is None:
             log.error("Error: no response received")
         elif frame.crc_ok:
-            oi = R.get_by_id(frame.oid)
-            if oi.response_data_type != DataType.UNKNOWN:
-                try:
-                    value = decode_value(oi.response_data_type, frame.payload)
-                except ValueError:
-                    value = frame.payload.hex(' ')
-                if isinstance(value, (int, float)):
-                    value = round(value, 1)
-            else:
-                value = frame.payload.hex(' ')
-            readings[oi.name] = value
+            value = entry.decode(frame.payload)
         else:
             log.error("Error wrong crc in response!")
+        readings[i] = value
 
-    log.debug(f'Readings complete len: {len(readings)}.')
+    log.debug('Readings complete len: %d.', len(plan))
     return readings
 
 
@@ -69,26 +116,62 @@ def read_oid(reader: RctReader, oid: str) -> tuple[str, any]:
         return oid, None
 
 
-def get_units(oid_names: set[str]) -> dict[str, str]:
-    result = {}
-    for oid_name in oid_names:
-        oid = R.get_by_name(oid_name)
-        result[oid_name] = oid.unit if oid.unit else ''
-    return result
+_clock_cache: list = [0, '']
+
+
+def clock_str() -> str:
+    '''
+    Returns the current local time as HH:MM:SS, formatted at most once per second.
+    '''
+    now = int(time.time())
+    if now != _clock_cache[0]:
+        _clock_cache[:] = [now, time.strftime('%H:%M:%S', time.localtime(now))]
+    return _clock_cache[1]
+
+
+#: Measurement and tags of the InfluxDB line protocol records, identical for every tick
+LINE_PREFIX = 'pv,inverter=RCT '
+
+
+def _format_field(key: str, value: any) -> str:
+    # same encoding as influxdb_client's Point, so the field types in the database do not change
+    if isinstance(value, bool):
+        return f'{key}={"true" if value else "false"}'
+    if isinstance(value, int):
+        return f'{key}={value}i'
+    if isinstance(value, float):
+        text = str(value)
+        return f'{key}={text[:-2] if text.endswith(".0") else text}'
+    text = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return f'{key}="{text}"'
+
+
+def make_line(fields: dict[str, any], timestamp: int) -> Optional[str]:
+    '''
+    Formats the fields of one tick as InfluxDB line protocol record, timestamp in seconds.
+    Non finite floats are skipped as the line protocol can not represent them, like Point the fields are sorted
+    and None is returned if no field is left.
+    '''
+    field_set = ','.join(_format_field(k, v) for k, v in sorted(fields.items())
+                         if not isinstance(v, float) or math.isfinite(v))
+    if not field_set:
+        return None
+    return f'{LINE_PREFIX}{field_set} {timestamp}'
 
 
 def report_frame_callback(frame: ResponseFrame):
-    now = datetime.now()
+    if not log.isEnabledFor(logging.INFO):
+        return  # nothing would be reported, skip decoding
     oid = R.get_by_id(frame.oid)
     ftype = oid.response_data_type
     try:
         if ftype != DataType.UNKNOWN:
             value = decode_value(ftype, frame.payload)
-            log.info(f'{now.strftime("%H:%M:%S")}: Response {oid.name} ({oid.object_id}): '
+            log.info(f'{clock_str()}: Response {oid.name} ({oid.object_id}): '
                   f'value: {value}, type: {ftype}')
         else:
             value = frame.payload.hex(' ')
-            log.info(f'{now.strftime("%H:%M:%S")}: Response with unknown type {oid.name} '
+            log.info(f'{clock_str()}: Response with unknown type {oid.name} '
                   f'({oid}): raw value: {value}')
     except KeyError as ex:
         log.error(f'Error: Cannot decode value: {ex}')
@@ -131,8 +214,12 @@ def monitor_inverter_influx(
 
     while True:
         try:
-            with InfluxDBClient(url=influx_url, token=f'{username}:{password}', org='-') as influx:
-                with influx.write_api(write_options=SYNCHRONOUS) as write_api:
+            # batches of line protocol compress well, gzip keeps the requests small
+            with InfluxDBClient(url=influx_url, token=f'{username}:{password}', org='-', enable_gzip=True,
+                                timeout=10_000) as influx:
+                # the client collects the points of several ticks and sends them with one request
+                write_options = WriteOptions(batch_size=500, flush_interval=10_000, jitter_interval=2_000)
+                with influx.write_api(write_options=write_options) as write_api:
                     monitor_inverter(rct_inverter_host, rct_inverter_port, write_api)
         except urllib3.exceptions.HTTPError as ex:
             log.error(f'HTTP error when writing to database: {ex}')
@@ -174,15 +261,27 @@ def monitor_inverter(
         'energy.e_dc_day[1]': 'day_energy_panel_1',            # Day energy produced string 1 (Wh)
     }
 
-    units = get_units(short_interval_readings.keys())
-    units |= get_units(long_interval_readings.keys())
+    # resolve the OIDs once, the loop below only works on the plans
+    short_plan = build_oid_plan(short_interval_readings)
+    long_plan = build_oid_plan(long_interval_readings)
+    combined_plan = short_plan + long_plan
+    # the summary lines only differ in the value, label and unit are formatted once
+    short_templates = tuple(f'{entry.name}: {{}} {entry.unit}' for entry in short_plan)
+    long_templates = tuple(f'{entry.name}: {{}}{entry.unit}' for entry in long_plan)
+    # positions of the readings in the combined plan, the long readings follow the short ones
+    long_start = len(short_plan)
+    panel_indexes = [i for i, entry in enumerate(short_plan)
+                     if entry.name in ('dc_conv.dc_conv_struct[0].p_dc', 'dc_conv.dc_conv_struct[1].p_dc')]
 
     bucket = 'photovoltaic/autogen'
 
-    interval_short = timedelta(seconds=5)
-    interval_long = timedelta(minutes=1)
-    last_time_long = datetime.now() - interval_long
-    readings: dict[str, any] = {}
+    # intervals in seconds, scheduled on the monotonic clock
+    interval_short = 5.0
+    interval_long = 60.0
+    monotonic = time.monotonic
+    last_time_long = monotonic() - interval_long
+    # reused for every tick, only the part of the plan read in a tick is valid
+    readings: list[any] = [None] * len(combined_plan)
     read_retries: int = 0
     connect_retries: int = 0
     max_retries: int = 5
@@ -192,62 +291,65 @@ def monitor_inverter(
             with RctReader(rct_inverter_host, rct_inverter_port, buffer_size=512, timeout=3.0,
                         ignore_crc=True) as reader:
                 read_retries = 0
+                deadline = monotonic()
                 while read_retries < max_retries and not reader.server_closed_conn:
                     log.info("Reading...")
-                    start = datetime.now()
+                    start = monotonic()
+                    deadline += interval_short
+                    timestamp = int(time.time())  # epoch seconds, written with precision S
                     try:
-                        readings = read_oid_set(reader, short_interval_readings.keys())
-
-                        now = datetime.now()
-                        log.info(f'{now.strftime("%H:%M:%S")}: Summary Short Readings:')
-                        for k, v in readings.items():
-                            log.info(f'{k}: {v} {units[k]}')
-                        log.info('----')
-
-                        if readings and write_api:
-                            point = Point("pv").tag("inverter", "RCT")
-
-                            for k, v in short_interval_readings.items():
-                                if k in readings:
-                                    point = point.field(v, readings[k])
-                            point = point.field('power_panel', readings['dc_conv.dc_conv_struct[0].p_dc'] +
-                                                    readings['dc_conv.dc_conv_struct[1].p_dc'])
-                            log.info('writing to InfluxDB')
-                            write_api.write(bucket=bucket, record=point)
-                            read_retries = 0
+                        # when the long lived values are due they are requested in the same batch
+                        read_long = start - last_time_long >= interval_long
+                        read_oid_set(reader, combined_plan if read_long else short_plan, readings)
+
+                        if log.isEnabledFor(logging.INFO):
+                            log.info(f'{clock_str()}: Summary Short Readings:\n' +
+                                     '\n'.join(template.format(value)
+                                               for template, value in zip(short_templates, readings)
+                                               if value is not None))
+                            log.info('----')
 
-                        if start - last_time_long >= interval_long:
-                            # read long lived values...
-                            readings = read_oid_set(reader, long_interval_readings.keys())
-                            now = datetime.now()
-                            log.info(f'{now.strftime("%H:%M:%S")}: Summary Long Readings:')
-                            for k, v in readings.items():
-                                log.info(f'{k}: {v}{units[k]}')
-
-                            if readings and write_api:
-                                for k, v in long_interval_readings.items():
-                                    if k in readings:
-                                        point = point.field(v, readings[k])
-                                write_api.write(bucket=bucket, record=point)
+                        # collect the fields of this tick and write them with a single point
+                        fields: dict[str, any] = {}
+                        for entry, value in zip(short_plan, readings):
+                            if value is not None:
+                                fields[entry.field] = value
+                        if all(readings[i] is not None for i in panel_indexes):
+                            fields['power_panel'] = sum(readings[i] for i in panel_indexes)
+
+                        if read_long:
+                            if log.isEnabledFor(logging.INFO):
+                                log.info(f'{clock_str()}: Summary Long Readings:\n' +
+                                         '\n'.join(template.format(readings[i])
+                                                   for i, template in enumerate(long_templates, long_start)
+                                                   if readings[i] is not None))
+
+                            for i, entry in enumerate(long_plan, long_start):
+                                if readings[i] is not None:
+                                    fields[entry.field] = readings[i]
                             log.info('----')
                             last_time_long = start
                             read_retries = 0
-                        end = datetime.now()
+
+                        line = make_line(fields, timestamp)
+                        if line and write_api:
+                            log.info('writing to InfluxDB')
+                            write_api.write(bucket=bucket, record=line, write_precision=WritePrecision.S)
+                            read_retries = 0
                     except TimeoutError:
-                        now = datetime.now()
-                        log.error(f'{now.strftime("%H:%M:%S")}: Timeout when reading, retrying now')
+                        log.error(f'{clock_str()}: Timeout when reading, retrying now')
                         time.sleep(1.0)
-                        end = start + interval_short  # immediately retry again
+                        deadline = monotonic()  # immediately retry again
                         read_retries += 1
                     except BaseException as ex:  # pylint: disable=broad-exception-caught
-                        now = datetime.now()
-                        end = now
                         read_retries += 1
-                        log.error(f'{now.strftime("%H:%M:%S")}: General exception {ex}', exc_info=True)
+                        log.error(f'{clock_str()}: General exception {ex}', exc_info=True)
 
-                    remaining = (interval_short - (end - start)).seconds
+                    remaining = deadline - monotonic()
                     if remaining > 0:
                         time.sleep(remaining)
+                    else:
+                        deadline = monotonic()  # overrun, start the next tick now without catching up
                 retries = 0
                 if reader.server_closed_conn:
                     log.error("Server closed connection, reconnecting in 5s")
@@ -260,28 +362,34 @@ def monitor_inverter(
     raise Exception('Aborting program, too many attempts to connect to connect to inverter.')
 
 
-def read_all_values(rct_inverter_host: str, rct_inverter_port: str = '8899'):
+def read_all_values(rct_inverter_host: str, rct_inverter_port: str = '8899', batch_size: int = 16):
     all_params = [x.name for x in R.all()]
-    units = get_units(all_params)
 
     with RctReader(rct_inverter_host, rct_inverter_port, buffer_size=512, timeout=3.0,
                    ignore_crc=True) as reader:
         log.info(f'Reading {len(all_params)} values...')
-        for oid_name in all_params:
-            now = datetime.now()
-            retries = 3
-            retry = 0
-            success = False
-            while not success and retry < retries:
-                try:
-                    log.error(f'{now.strftime("%H:%M:%S")}: Timeout, retrying {retry}/{retries}')
-                    name, value = read_oid(reader, oid_name)
-                    log.info(f'{name}: {value} {units[name]}')
-                    success = True
-                except TimeoutError:
-                    time.sleep(1.0 * (retry + 1))
-                    retry += 1
-                    log.error('Timeout.')
+        # request the values in pipelined batches instead of one round trip per OID
+        for batch_start in range(0, len(all_params), batch_size):
+            plan = build_oid_plan({name: name for name in all_params[batch_start:batch_start + batch_size]})
+            try:
+                readings = read_oid_set(reader, plan)
+            except TimeoutError:
+                # some OIDs are not answered, read this batch one by one to get the others
+                log.error(f'{clock_str()}: Timeout, reading batch of {len(plan)} values one by one')
+                readings = [read_value_with_retries(reader, entry.name) for entry in plan]
+            for entry, value in zip(plan, readings):
+                log.info(f'{entry.name}: {value} {entry.unit}')
+
+
+def read_value_with_retries(reader: RctReader, oid_name: str, retries: int = 3) -> any:
+    for retry in range(retries):
+        try:
+            return read_oid(reader, oid_name)[1]
+        except TimeoutError:
+            log.error(f'{clock_str()}: Timeout, retrying {retry + 1}/{retries}')
+            time.sleep(1.0 * (retry + 1))
+    return None
+
 
 def print_stacktrace(sig, frame):
     traceback.print_stack()
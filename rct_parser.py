@@ -1,10 +1,15 @@
 
 from datetime import datetime
-from rctclient.types import Command, FrameType
-from rctclient.utils import CRC16
+from typing import Any, Callable
+from rctclient.types import Command, DataType, FrameType
+from rctclient.utils import decode_value
 from rctclient.exceptions import FrameCRCMismatch, InvalidCommand  # , FrameLengthExceeded
 
+import binascii
+import bisect
+import functools
 import logging
+import re
 import struct
 
 #: Token that starts a frame
@@ -24,10 +29,73 @@ FRAME_LENGTH_CRC16 = 2
 
 #: Amount of bytes we need to have a command
 BUFFER_LEN_COMMAND = 2
+#: Longest possible header: start token, long command, 2 bytes length, plant address and OID
+FRAME_MAX_HEADER_LENGTH = FRAME_HEADER_WITH_LENGTH + 4 + 4
+#: Pattern to locate start token candidates, works on any buffer without copying
+_START_TOKEN_RE = re.compile(rb'\+')
+#: Pattern to locate escaped start or escape tokens
+_ESCAPE_SEQUENCE_RE = re.compile(rb'-[+-]')
+#: Prebuilt structs for the big endian header fields and the checksum
+_UINT16 = struct.Struct('>H')
+_UINT32 = struct.Struct('>I')
+#: Commands by their byte value, a dict lookup is cheaper than calling the Enum
+_COMMANDS = {command.value: command for command in Command}
+#: Commands with plant address and with two byte length, checked once per frame
+_PLANT_COMMANDS = frozenset(command for command in Command if Command.is_plant(command))
+_LONG_COMMANDS = frozenset(command for command in Command if Command.is_long(command))
+#: Shared escape_indexes of frames without escape sequences, saves a new list per frame
+_NO_ESCAPES = ()
 log = logging.getLogger(__name__)
 
 
+def crc16_ccitt(data: bytes) -> int:
+    '''
+    Calculates the CRC16 (CCITT, start value 0xFFFF) checksum of data like rctclient.utils.CRC16 does, including
+    the padding with a zero byte if the length is uneven. The table driven calculation is done by binascii in C
+    and works on memoryviews without copying them.
+    '''
+    crc = binascii.crc_hqx(data, 0xFFFF)
+    if len(data) & 0x01:
+        crc = binascii.crc_hqx(b'\x00', crc)
+    return crc
+
+
+#: Prebuilt structs for the fixed size numeric types, same formats as rctclient.utils.decode_value
+_VALUE_STRUCTS = {
+    DataType.UINT8: struct.Struct('>B'),
+    DataType.ENUM: struct.Struct('>B'),
+    DataType.INT8: struct.Struct('>b'),
+    DataType.UINT16: struct.Struct('>H'),
+    DataType.INT16: struct.Struct('>h'),
+    DataType.UINT32: struct.Struct('>I'),
+    DataType.INT32: struct.Struct('>i'),
+    DataType.FLOAT: struct.Struct('>f'),
+}
+#: Types decoded with a struct, decoding a payload of the right size can not fail
+FIXED_SIZE_TYPES = frozenset(_VALUE_STRUCTS)
+
+
+def make_decoder(data_type: DataType) -> Callable[[bytes], Any]:
+    '''
+    Returns a function decoding a payload of the given type like rctclient.utils.decode_value does. Fixed size
+    numeric types use a prebuilt struct, payloads of unknown type are returned as hex string.
+    '''
+    if data_type == DataType.UNKNOWN:
+        return lambda payload: payload.hex(' ')
+    value_struct = _VALUE_STRUCTS.get(data_type)
+    if value_struct:
+        unpack = value_struct.unpack
+        return lambda payload: unpack(payload)[0]
+    return functools.partial(decode_value, data_type)
+
+
 class ResponseFrame:
+    '''
+    A received frame. The payload is an unescaped bytes copy owned by the frame, it stays valid after the receive
+    buffer it was parsed from is reused.
+    '''
+    __slots__ = ('command', 'oid', 'crc16', 'crc_ok', 'address', 'frame_length', 'frame_type', 'payload')
+
     def __init__(self,
             command: Command,
             oid: int,
@@ -49,61 +117,48 @@ class ResponseFrame:
 
 
 class FrameParser:
+    __slots__ = ('ignore_crc_mismatch', 'complete_frame', 'current_pos', 'escape_indexes')
+
     def __init__(self, ignore_crc: bool = False):
         self.ignore_crc_mismatch: bool = ignore_crc
         self.complete_frame: bool
         self.current_pos: int = 0   # index where to start parsing next frame
-        self.escape_indexes = []
+        self.escape_indexes = _NO_ESCAPES
         self.reset()  # init all variables
 
     def reset(self):
         self.complete_frame = True
-        self.escape_indexes = []
+        self.escape_indexes = _NO_ESCAPES
 
     def rewinded(self):
         self.current_pos = 0
 
-    def _find_byte_tuple(self, data: bytes, byte_pair: bytes):
-        pos = 0
-        for pos in range(len(data) - 1):
-            if data[pos] == byte_pair[0] and data[pos + 1] == byte_pair[1]:
-                return pos
-        return -1
-
-    def _unescape_buffer_old(self, buffer: memoryview) -> memoryview:
-        esc_seq = b'-+'
-        new_buffer = buffer
-
-        pos = self._find_byte_tuple(buffer, esc_seq)
-        if pos >= 0:
-            log.debug(f'Found escape sequence 1 at {pos}')
-            new_buffer = buffer.tobytes().replace(esc_seq, b'+')
-            new_buffer = memoryview(new_buffer)
-        esc_seq = b'--'
-        pos = self._find_byte_tuple(new_buffer, esc_seq)
-        if pos >= 0:
-            log.debug(f'Found escape sequence 2 at {pos}')
-            new_buffer = new_buffer.tobytes().replace(esc_seq, b'-')
-            new_buffer = memoryview(new_buffer)
-        return new_buffer
-
-    def _find_escaped_byte(self, data: bytes):
-        pos = 0
-        for pos in range(len(data) - 1):
-            if data[pos] == ord(b'-') and (data[pos + 1] == ord(b'+') or data[pos + 1] == ord(b'-')):
-                return pos
-        return -1
+    def skip_start_token(self, start: int):
+        # continue behind the start token of an invalid frame, the next parse call resyncs to the next one
+        self.current_pos = start + 1
+        self.complete_frame = True
 
     def _unescape_buffer(self, buffer: memoryview) -> memoryview:
-        new_buffer = buffer
-
-        while (pos := self._find_escaped_byte(new_buffer)) >= 0:
-            log.debug(f'Found escape sequence at {pos}')
-            new_buffer = new_buffer.tobytes()
-            new_buffer = new_buffer[0:pos] + new_buffer[pos + 1:]
-            new_buffer = memoryview(new_buffer)
-            self.escape_indexes.append(pos + self.current_pos)
-        return new_buffer
+        # collect the runs between escape tokens and join them in a single pass,
+        # the escaped byte itself is the first byte of the following run.
+        # escape_indexes gets the index of each escaped byte in the unescaped buffer
+        match = _ESCAPE_SEQUENCE_RE.search(buffer)
+        if match is None:  # the common case, nothing to unescape
+            self.escape_indexes = _NO_ESCAPES
+            return buffer
+        runs = []
+        escape_indexes = []
+        last = 0
+        while match:
+            pos = match.start()
+            log.debug('Found escape sequence at %d', pos)
+            runs.append(buffer[last:pos])
+            escape_indexes.append(pos - len(escape_indexes))
+            last = pos + 1
+            match = _ESCAPE_SEQUENCE_RE.search(buffer, pos + 2)
+        self.escape_indexes = escape_indexes
+        runs.append(buffer[last:])
+        return memoryview(b''.join(runs))
 
     def log_state_into_file(self, msg: str, buffer: memoryview):
         now = datetime.now()
@@ -119,7 +174,6 @@ class FrameParser:
     def parse(self, buffer: memoryview) -> ResponseFrame:
         frame: ResponseFrame = None
         frame_type: FrameType = None
-        data = bytearray()
         address: int = 0
         frame_length: int = 0
         crc_ok: bool = False
@@ -127,86 +181,94 @@ class FrameParser:
         # 1 byte start, 1 byte command, 1 byte length, no address, 4 byte ID
         frame_header_length: int = 1 + 1 + 1 + 0 + 4
 
-        log.debug(f'Buffer length: {len(buffer)}: {buffer.hex(" ")}')
-        log.debug(f'current pos: {self.current_pos}')
+        debug = log.isEnabledFor(logging.DEBUG)
+        if debug:
+            log.debug('Buffer length: %d: %s', len(buffer), buffer.hex(' '))
+            log.debug('current pos: %d', self.current_pos)
         # start token not yet found, find it
         i = self.current_pos
         start = -1
         length = len(buffer)
         if self.complete_frame and self.current_pos < length:
-            log.debug("trying to find next frame")
             self.reset()
 
         while start < 0 and i < length:
-            c = buffer[i]
-            log.debug(f'read: 0x{c:02x} at index {i}')
+            # jump to the next candidate start token, the scan itself runs in C
+            match = _START_TOKEN_RE.search(buffer, i)
+            if match is None:
+                i = length
+                break
+            i = match.start()
             # sync to start_token
-            if c == START_TOKEN:
-                if i > 0 and buffer[i - 1] == ESCAPE_TOKEN:
-                    log.debug('escaped start token found, ignoring')
+            if i > self.current_pos and buffer[i - 1] == ESCAPE_TOKEN:  # bytes before current_pos are consumed
+                log.debug('escaped start token found, ignoring')
+            else:
+                j = i + 1
+                while j < length and buffer[j] == START_TOKEN:
+                    j += 1  # there are special "end of block" markers 2B 2B 2B" -> skip
+                if j == i + 1:  # no more following 1Bs -> start token found
+                    start = i
                 else:
-                    j = i + 1
-                    while j < length and buffer[j] == START_TOKEN:
-                        j += 1  # there are special "end of block" markers 2B 2B 2B" -> skip
-                    if j == i + 1:  # no more following 1Bs -> start token found
-                        log.debug('start token found')
-                        start = i
-                    else:
-                        i = j      # skip 1B sequence
+                    i = j      # skip 1B sequence
             i += 1
 
         if start < 0:  # no start token found, exit
-            log.debug(f'no start token invalid data received len: {length}')
+            log.debug('no start token invalid data received len: %d', length)
             self.current_pos = length  # we do not scan garbage data next time
             self.complete_frame = False
             return None
 
         start_token_pos = i - 1
-        unescaped_buffer = memoryview(buffer)[start:]
-        unescaped_buffer = self._unescape_buffer(unescaped_buffer)
-        log.debug(f'Escaped buffer length: {len(unescaped_buffer)}: {unescaped_buffer.hex(" ")}',)
+        view = buffer if isinstance(buffer, memoryview) else memoryview(buffer)
+        # unescape only what belongs to this frame and not the whole rest of the buffer. An escaped part is
+        # at most twice as long as the unescaped one, start with the longest header to get the frame length
+        escaped_end = min(length, start + 2 * FRAME_MAX_HEADER_LENGTH)
+        unescaped_buffer = self._unescape_buffer(view[start:escaped_end])
+        if debug:
+            log.debug('Escaped buffer length: %d: %s', len(unescaped_buffer), unescaped_buffer.hex(' '))
 
         length = len(unescaped_buffer)
         i = 1  # index 0 is now start token
-        log.debug(f'unescaped length: {length}')
 
         if i < length:
             c = unescaped_buffer[i]
-            log.debug(f'read: 0x{c:02x} at index {i}')
 
         if length - i >= BUFFER_LEN_COMMAND:
-            try:
-                command = Command(c)
-            except ValueError as exc:
-                self.log_state_into_file(str(exc), buffer)
-                raise InvalidCommand(str(exc), c, i) from exc
+            command = _COMMANDS.get(c)
+            if command is None:
+                msg = f'{c} is not a valid Command'
+                self.log_state_into_file(msg, buffer)
+                self.skip_start_token(start)
+                raise InvalidCommand(msg, c, i)
 
             if command == Command.EXTENSION:
+                self.skip_start_token(start)
                 raise InvalidCommand('EXTENSION is not supported', c, i)
 
-            log.debug(f'have command: 0x{command:02x}, is_plant: {Command.is_plant(command)}')
-            if Command.is_plant(command):
+            is_plant = command in _PLANT_COMMANDS
+            is_long = command in _LONG_COMMANDS
+            if debug:
+                log.debug('have command: 0x%02x, is_plant: %s', command, is_plant)
+            if is_plant:
                 frame_header_length += 4
                 frame_type = FrameType.PLANT
-                log.debug(f'plant frame, extending header length by 4 to {frame_header_length}')
-            if Command.is_long(command):
+                log.debug('plant frame, extending header length by 4 to %d', frame_header_length)
+            if is_long:
                 frame_header_length += 1
                 frame_type = FrameType.STANDARD
-                log.debug(f'long cmd, extending header length by 1 to {frame_header_length}')
+                log.debug('long cmd, extending header length by 1 to %d', frame_header_length)
             i += 1
         if length >= frame_header_length:
-            log.debug(f'buffer length {i} indicates that it contains entire header')
-            if Command.is_long(command):
-                data_length = struct.unpack('>H', unescaped_buffer[i:i + 2])[0]
+            if is_long:
+                data_length = _UINT16.unpack_from(unescaped_buffer, i)[0]
                 address_idx = 4
             else:
-                data_length = struct.unpack('>B', bytes([unescaped_buffer[i]]))[0]
+                data_length = unescaped_buffer[i]
                 address_idx = 3
-            log.debug(f'found data_length: {data_length} bytes')
-            if Command.is_plant(command):
+            if is_plant:
                 # length field includes address and id length == 8 bytes
                 frame_length = (frame_header_length - 8) + data_length + FRAME_LENGTH_CRC16
-                address = struct.unpack('>I', unescaped_buffer[address_idx:address_idx + 4])[0]
+                address = _UINT32.unpack_from(unescaped_buffer, address_idx)[0]
                 oid_idx = address_idx + 4
                 data_length -= 8  # includes length of oid and plant-id
             else:
@@ -215,28 +277,33 @@ class FrameParser:
                 oid_idx = address_idx
                 data_length -= 4  # includes length of oid
 
-            log.debug(f'data_length: {data_length} bytes, frame_length: {frame_length}')
-            oid = struct.unpack('>I', unescaped_buffer[oid_idx:oid_idx + 4])[0]
-            log.debug(f'oid index: {oid_idx}, OID: 0x{oid:02x}')
+            if escaped_end < len(buffer) and escaped_end < start + 2 * frame_length:
+                escaped_end = min(len(buffer), start + 2 * frame_length)
+                unescaped_buffer = self._unescape_buffer(view[start:escaped_end])
+                length = len(unescaped_buffer)
+            oid = _UINT32.unpack_from(unescaped_buffer, oid_idx)[0]
+            if debug:
+                log.debug('OID: 0x%08x, data_length: %d bytes, frame_length: %d', oid, data_length, frame_length)
             i = oid_idx + 4
-            log.debug(f'i is: {i}')
         if frame_length > 0 and length >= frame_length:
-            log.debug(f'buffer contains full frame, index: {i}')
-            data[:] = unescaped_buffer[i:i + data_length]
-            log.debug(f'extracted data from: {i} to {i + data_length}: {data.hex(" ")}')
+            # single copy out of the receive buffer, frames outlive the buffer contents
+            data = bytes(unescaped_buffer[i:i + data_length])
+            if debug:
+                log.debug('extracted data from: %d to %d: %s', i, i + data_length, data.hex(' '))
             i += data_length
-            log.debug(f'crc i is: {i}')
-            crc16 = struct.unpack('>H', unescaped_buffer[i:i + 2])[0]
-            calc_crc16 = CRC16(unescaped_buffer[1:i])
+            crc16 = _UINT16.unpack_from(unescaped_buffer, i)[0]
+            calc_crc16 = crc16_ccitt(unescaped_buffer[1:i])
             crc_ok = crc16 == calc_crc16
-            log.debug(f'crc: {crc16:04x} calculated: {calc_crc16:04x} match: {crc_ok}')
 
             if not crc_ok and not self.ignore_crc_mismatch:
+                self.skip_start_token(start)
                 raise FrameCRCMismatch('CRC mismatch', crc16, calc_crc16, i)
-            self.current_pos = start_token_pos + i + 2
+            # continue behind the frame, each escaped byte in it took two bytes in the buffer
+            self.current_pos = start_token_pos + i + 2 + bisect.bisect_left(self.escape_indexes, i + 2)
             self.complete_frame = True
-            log.debug(f'returning completed frame, len: {frame_length}, start pos: {start_token_pos}, '
-                f'next pos: {self.current_pos}')
+            if debug:
+                log.debug('returning completed frame, len: %d, start pos: %d, next pos: %d, crc: %04x match: %s',
+                          frame_length, start_token_pos, self.current_pos, calc_crc16, crc_ok)
             frame = ResponseFrame(
                 command=command,
                 oid=oid,
@@ -248,12 +315,10 @@ class FrameParser:
                 payload=data,
             )
         else:
-            log.debug(f'frame is incomplete, stopping at {i}')
+            log.debug('frame is incomplete, stopping at %d', i)
             self.reset()
             self.complete_frame = False
+            # continue at the start token when more data arrived, the bytes before it are not scanned again
+            self.current_pos = start
 
-        for escape_index in self.escape_indexes:
-            if self.current_pos >= escape_index:
-                self.current_pos += 1
-                break
         return frame
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import functools
 import logging
 import socket
 from typing import Callable
@@ -87,6 +88,19 @@ log = logging.getLogger(__name__)
 
 MAX_FRAME_SIZE = 1024
 
+#: REGISTRY.get_by_name scans all known OIDs, the OIDs read periodically are resolved only once
+get_oid_by_name = functools.lru_cache(maxsize=None)(R.get_by_name)
+
+
+@functools.lru_cache(maxsize=None)
+def build_requests(oid_names: tuple[str, ...]) -> tuple[tuple[int, ...], bytes]:
+    '''
+    Returns the object ids and the concatenated READ command frames for the given OIDs. The OID sets read
+    periodically never change, their frames are built once and reused.
+    '''
+    object_ids = tuple(get_oid_by_name(oid_name).object_id for oid_name in oid_names)
+    return object_ids, b''.join(make_frame(command=Command.READ, id=object_id) for object_id in object_ids)
+
 
 class InvalidOidError(FrameError):
     '''
@@ -109,22 +123,34 @@ class RctReader:
             buffer_size: int = 2048,
             ignore_crc: bool = False
     ):
+        # receive buffer and a view on it, both are reused for all reads on this connection
         self.buffer = bytearray(buffer_size)
-        self.start = 0
+        self.view = memoryview(self.buffer)
+        self.filled = 0  # number of received bytes in buffer, parsing continues at parser.current_pos
         self.host = host
         self.port = port
         self.timeout = timeout
         self.parser = FrameParser(ignore_crc)
         self.sock = None
         self.on_frame_received = None
-        self.rewind_threshold = min(MAX_FRAME_SIZE, buffer_size / 2)
-        log.debug(f'Reader initialized with buffer size {buffer_size}')
+        self.rewind_threshold = min(MAX_FRAME_SIZE, buffer_size // 2)
+        self.rewind_limit = buffer_size - self.rewind_threshold  # fill level that enforces a rewind
+        log.debug('Reader initialized with buffer size %d', buffer_size)
         self.server_closed_conn = False
 
     def __enter__(self):
         # open the socket and connect to the remote device:
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.settimeout(self.timeout)
+        # requests are tiny frames, send them right away instead of waiting for more data (Nagle)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # let the OS detect a silently dropped connection. The default keepalive starts probing after 2 hours,
+        # probe an idle connection after 10s every 5s and give up after 3 unanswered probes where supported
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 10)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 5)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
         self.sock.connect((self.host, self.port))
         return self
 
@@ -135,18 +161,73 @@ class RctReader:
     def register_callback(self, fn: Callable[[ResponseFrame], None]):
         self.on_frame_received = fn
 
-    def read_frames(self, oid_names: set[str]) -> list[ResponseFrame]:
-        result = []
-        for oid_name in oid_names:  # frames_to_request:
-            if not self.server_closed_conn:
-                oid = R.get_by_name(oid_name)
-                log.debug(f'Sending command {oid_name}')
-                result.append(self._read_frame(oid))
+    def clear_received(self):
+        '''
+        Drops the received bytes that are not parsed yet and resets the parser.
+        '''
+        self.filled = 0
+        self.parser.reset()
+        self.parser.rewinded()
 
+    def discard_received(self):
+        '''
+        Drops everything received so far, including the data already waiting on the socket. Late responses to
+        earlier requests and unsolicited frames are not taken as responses to the requests sent next.
+        '''
+        self.clear_received()
+        self.sock.setblocking(False)
+        try:
+            while True:
+                if self.sock.recv_into(self.view) == 0:
+                    self.server_closed_conn = True
+                    break
+        except BlockingIOError:
+            pass  # nothing more waiting
+        finally:
+            self.sock.settimeout(self.timeout)
+
+    def read_frames(self, oid_names: list[str]) -> list[ResponseFrame]:
+        '''
+        Read the given OIDs pipelined: all requests are sent first, then the responses are collected in any order.
+        The result has one entry per name in the order of oid_names, None if no response was received.
+        '''
+        def on_received(frame: ResponseFrame):
+            index = indexes.get(frame.oid)
+            if index is None:
+                log.debug('discarding unwanted frame')
+            else:
+                # a later frame for the same OID replaces an unsolicited one received before the response
+                result[index] = frame
+                pending.discard(frame.oid)
+
+        object_ids, requests = build_requests(tuple(oid_names))
+        result: list[ResponseFrame] = [None] * len(object_ids)
+        indexes = {object_id: i for i, object_id in enumerate(object_ids)}
+        pending = set(object_ids)
+        self.discard_received()
+        if self.server_closed_conn:
+            return result
+        self.register_callback(on_received)
+        # all requests are sent with a single write
+        log.debug('Sending %d commands', len(object_ids))
+        self.sock.sendall(requests)
+        try:
+            while pending and not self.server_closed_conn:
+                self.recv_frame(len(pending))
+        except TimeoutError:
+            # the missing responses may still arrive later, they are not parsed as responses of the next call
+            self.clear_received()
+            raise
+        # frames received together with the last response may be the actual responses, if unsolicited frames
+        # for the same OIDs came first
+        try:
+            self.recv_frame(buffered_only=True)
+        except FrameError as ex:
+            log.warning('Invalid frame after the responses: %s', ex)  # the responses themselves are complete
         return result
 
     def read_frame(self, oid_name: str) -> ResponseFrame:
-        oid = R.get_by_name(oid_name)
+        oid = get_oid_by_name(oid_name)
         return self._read_frame(oid)
 
     def _read_frame(self, oid: ObjectInfo, wanted_ids: set[int] = None) -> ResponseFrame:
@@ -164,33 +245,39 @@ class RctReader:
         self.register_callback(on_received)
         if oid:
             send_frame = make_frame(command=Command.READ, id=oid.object_id)
-            log.debug(f'Sending command {oid.name}')
+            self.discard_received()
+            log.debug('Sending command %s', oid.name)
             self.sock.sendall(send_frame)
         while not response_frame and not self.server_closed_conn:
             self.recv_frame(1)
         return response_frame
 
-    def recv_frame(self, no_frames: int = 0) -> list[ResponseFrame]:
+    def recv_frame(self, no_frames: int = 0, buffered_only: bool = False) -> list[ResponseFrame]:
+        '''
+        Receives and parses frames until no_frames frames are complete, all frames until the connection is closed
+        or a timeout occurs if no_frames is 0. With buffered_only only the bytes already received are parsed.
+        '''
         # query information about an object ID (here: battery.soc):
-        bytes_read = self.parser.current_pos
-        buffer_pos = 0
         frames_received = 0
         continue_parsing = True
-        mv: memoryview = None
+        # bytes received but not yet parsed in a previous call are still in the buffer
+        mv: memoryview = self.view[0:self.filled]
         responses: list[ResponseFrame] = []
+        debug = log.isEnabledFor(logging.DEBUG)  # decode values for the debug log only if it is written
+        parser = self.parser
+        recv_into = self.sock.recv_into
 
         # continue parsing until either all expected frames are received or
         # a timeout occurs and no more data are available:
         while continue_parsing:
-            pos = self.parser.current_pos
             # read next chunk if remaining bytes in buffer are an incomplete
             # frame or buffer is empty:
-            if (not self.parser.complete_frame) or pos == bytes_read:
-                buffer_pos += bytes_read
-                socket_buffer_view = memoryview(self.buffer)[buffer_pos:len(self.buffer)]
+            if (not parser.complete_frame) or parser.current_pos == self.filled:
+                if buffered_only:
+                    break
                 try:
-                    bytes_read = self.sock.recv_into(socket_buffer_view, len(socket_buffer_view))
-                    log.debug(f'read bytes from socket: {bytes_read} to {buffer_pos}')
+                    bytes_read = recv_into(self.view[self.filled:])
+                    log.debug('read bytes from socket: %d to %d', bytes_read, self.filled)
                 except TimeoutError:
                     log.warning('Timeout, exiting recv')
                     raise
@@ -199,35 +286,34 @@ class RctReader:
                     self.server_closed_conn = True
                     return responses  # no more data available, connection closed
 
-                # create a new memory view for parser and reset pos:
-                log.debug(f'creating memory view from {buffer_pos} to {buffer_pos + bytes_read}')
-                mv = memoryview(self.buffer)[0:buffer_pos + bytes_read]
+                self.filled += bytes_read
+                mv = self.view[0:self.filled]
 
             # try to parse next frame
-            frame = self.parser.parse(mv)
-            log.debug(f'Parser complete: {self.parser.complete_frame}')
-            if self.parser.complete_frame:
+            frame = parser.parse(mv)
+            log.debug('Parser complete: %s', parser.complete_frame)
+            if parser.complete_frame:
                 frames_received += 1
                 if no_frames > 0:
-                    log.debug(f'Received {frames_received}, expected: {no_frames}')
+                    log.debug('Received %d, expected: %d', frames_received, no_frames)
                     continue_parsing = frames_received < no_frames
 
                 try:
                     oid = R.get_by_id(frame.oid)
-                    log.debug(f'Response frame received: {oid}, crc ok: {frame.crc_ok}')
-                    if log.getEffectiveLevel() == logging.DEBUG:
+                    log.debug('Response frame received: %s, crc ok: %s', oid, frame.crc_ok)
+                    if debug:
                         if oid.response_data_type != DataType.UNKNOWN:
                             try:
                                 value = decode_value(oid.response_data_type, frame.payload)
                             except KeyError as ex:
-                                log.debug(f'Error when decoding frame: {ex}')
+                                log.debug('Error when decoding frame: %s', ex)
                                 value = frame.payload.hex(' ')
                         else:
                             value = frame.payload.hex(' ')
-                        log.debug(f'Value: {value}, type: {oid.response_data_type}')
+                        log.debug('Value: %s, type: %s', value, oid.response_data_type)
                 except KeyError as ex:
                     msg = f'Unknown OID received: {frame.oid:04x}'
-                    self.parser.log_state_into_file(msg, mv)
+                    parser.log_state_into_file(msg, mv)
                     raise InvalidOidError(msg) from ex
                 if self.on_frame_received:
                     self.on_frame_received(frame)
@@ -235,23 +321,22 @@ class RctReader:
                     responses.append(frame)
 
                 # if all bytes are consumed we can rewind buffer to read next chunk at buffer start:
-                if self.parser.current_pos == buffer_pos + bytes_read:
+                if parser.current_pos == self.filled:
                     log.debug('Rewinding buffer')
-                    buffer_pos = 0
-                    bytes_read = 0
-                    self.parser.rewinded()
+                    self.filled = 0
+                    parser.rewinded()
 
             # rewind buffer if it fills up and copy remaining data then
-            if buffer_pos + bytes_read > len(self.buffer) - self.rewind_threshold:
+            if self.filled > self.rewind_limit:
                 log.debug("Enforce rewind, potential overflow")
-                pos = self.parser.current_pos
-                remaining_bytes = len(mv) - pos
-                log.debug(f'rewind buffer: {bytes_read=}, {pos=}, {len(mv)=}, {remaining_bytes=}')
-                self.buffer[0:remaining_bytes] = mv[pos:]
-                self.parser.rewinded()
-                buffer_pos = 0
-                bytes_read = len(mv) - pos
-                mv = memoryview(self.buffer)[0:remaining_bytes]
+                pos = parser.current_pos
+                remaining_bytes = self.filled - pos
+                log.debug('rewind buffer: filled=%d, pos=%d, remaining_bytes=%d', self.filled, pos, remaining_bytes)
+                # memoryview assignment moves the overlapping range in place, no temporary copy
+                self.view[0:remaining_bytes] = self.view[pos:self.filled]
+                parser.rewinded()
+                self.filled = remaining_bytes
+                mv = self.view[0:remaining_bytes]
 
         log.debug("Finished parsing")
         return responses
@@ -2,11 +2,14 @@ import logging
 import socket
 
 import pytest
+import pv_reader
 import rct_reader
+from influxdb_client import Point, WritePrecision
 from rctclient.utils import decode_value, encode_value
 from rctclient.frame import make_frame
 from rctclient.registry import REGISTRY as Reg
 from rctclient.types import Command, DataType
+from rctclient.exceptions import FrameCRCMismatch
 
 
 # https://docs.pytest.org/en/7.1.x/how-to/monkeypatch.html
@@ -14,6 +17,9 @@ class SocketMock:
     def __init__(self):
         self.counter = 0
         self.packets = None
+        self.sent = []
+        self.blocking = True
+        self.waiting = []  # data already on the socket before the next request, read by non blocking receives
 
     def connect(self, address):
         pass
@@ -22,9 +28,24 @@ class SocketMock:
         pass
 
     def settimeout(self, value):
+        self.blocking = True
+
+    def setblocking(self, flag):
+        self.blocking = flag
+
+    def setsockopt(self, level, option, value):
         pass
 
+    def sendall(self, data):
+        self.sent.append(bytes(data))
+
     def recv_into(self, buffer, nbytes=..., flags=...):  # pylint: disable=W0613
+        if not self.blocking:
+            if not self.waiting:
+                raise BlockingIOError()
+            packet_to_send = self.waiting.pop(0)
+            buffer[0:len(packet_to_send)] = packet_to_send
+            return len(packet_to_send)
         if self.counter < len(self.packets):
             packet_to_send = self.packets[self.counter]
             buffer[0:len(packet_to_send)] = packet_to_send
@@ -187,3 +208,111 @@ def test_buffer_rewind(mock_socket, caplog):
         resp = responses[2]
         value = decode_value(bat_cycles_objinfo.response_data_type, resp.payload)
         assert value == bat_cycles_value
+
+
+def test_read_frames_pipelined(mock_socket, caplog):
+    caplog.set_level(logging.DEBUG)
+    p_acc_lp_objinfo = Reg.get_by_name('g_sync.p_acc_lp')
+    bat_cycles_objinfo = Reg.get_by_name('battery.cycles')
+    soc_objinfo = Reg.get_by_name('battery.soc')
+
+    # responses arrive in a different order and with an unsolicited frame in between
+    test_packets = [
+        make_frame(command=Command.RESPONSE, id=bat_cycles_objinfo.object_id,
+                   payload=encode_value(bat_cycles_objinfo.request_data_type, 42)) +
+        make_frame(command=Command.RESPONSE, id=soc_objinfo.object_id,
+                   payload=encode_value(soc_objinfo.request_data_type, 0.5)),
+        make_frame(command=Command.RESPONSE, id=p_acc_lp_objinfo.object_id,
+                   payload=encode_value(p_acc_lp_objinfo.request_data_type, 123.0)),
+    ]
+    mock_socket.set_receive_data(test_packets)
+
+    with rct_reader.RctReader('localhost', "8899") as reader:
+        responses = reader.read_frames(['g_sync.p_acc_lp', 'battery.cycles'])
+
+    # all requests are sent with a single write
+    assert mock_socket.sent == [
+        make_frame(command=Command.READ, id=p_acc_lp_objinfo.object_id) +
+        make_frame(command=Command.READ, id=bat_cycles_objinfo.object_id)
+    ]
+    assert [resp.oid for resp in responses] == [p_acc_lp_objinfo.object_id, bat_cycles_objinfo.object_id]
+    assert decode_value(p_acc_lp_objinfo.response_data_type, responses[0].payload) == 123.0
+    assert decode_value(bat_cycles_objinfo.response_data_type, responses[1].payload) == 42
+
+
+def test_frames_kept_between_calls(mock_socket, caplog):
+    caplog.set_level(logging.DEBUG)
+    bat_cycles_objinfo = Reg.get_by_name('battery.cycles')
+
+    # both frames arrive with one recv, the second one must still be there for the next call
+    test_packets = [
+        make_frame(command=Command.RESPONSE, id=bat_cycles_objinfo.object_id,
+                   payload=encode_value(bat_cycles_objinfo.request_data_type, 1)) +
+        make_frame(command=Command.RESPONSE, id=bat_cycles_objinfo.object_id,
+                   payload=encode_value(bat_cycles_objinfo.request_data_type, 2)),
+    ]
+    mock_socket.set_receive_data(test_packets)
+
+    with rct_reader.RctReader('localhost', "8899") as reader:
+        first = reader.recv_frame(1)
+        second = reader.recv_frame(1)
+
+    assert decode_value(bat_cycles_objinfo.response_data_type, first[0].payload) == 1
+    assert decode_value(bat_cycles_objinfo.response_data_type, second[0].payload) == 2
+
+
+def test_read_frames_after_unsolicited_frame(mock_socket, caplog):
+    caplog.set_level(logging.DEBUG)
+    soc_objinfo = Reg.get_by_name('battery.soc')
+
+    def soc_frame(value: float) -> bytes:
+        return make_frame(command=Command.RESPONSE, id=soc_objinfo.object_id,
+                          payload=encode_value(soc_objinfo.request_data_type, value))
+
+    with rct_reader.RctReader('localhost', "8899") as reader:
+        # a broadcast arrives right before the response, the response behind it wins
+        mock_socket.set_receive_data([soc_frame(0.25) + soc_frame(0.5)])
+        responses = reader.read_frames(['battery.soc'])
+        assert decode_value(soc_objinfo.response_data_type, responses[0].payload) == 0.5
+
+        # a late frame waiting on the socket is dropped before the next requests are sent
+        mock_socket.waiting = [soc_frame(0.75)]
+        mock_socket.set_receive_data([soc_frame(1.0)])
+        responses = reader.read_frames(['battery.soc'])
+        assert decode_value(soc_objinfo.response_data_type, responses[0].payload) == 1.0
+        assert reader.filled == 0
+
+
+def test_frame_after_crc_mismatch(mock_socket, caplog):
+    caplog.set_level(logging.DEBUG)
+    bat_cycles_objinfo = Reg.get_by_name('battery.cycles')
+    corrupt_frame = bytearray(make_frame(command=Command.RESPONSE, id=bat_cycles_objinfo.object_id,
+                                         payload=encode_value(bat_cycles_objinfo.request_data_type, 1)))
+    corrupt_frame[-3] ^= 0x01  # payload does not match the check sum any more
+    good_frame = make_frame(command=Command.RESPONSE, id=bat_cycles_objinfo.object_id,
+                            payload=encode_value(bat_cycles_objinfo.request_data_type, 2))
+    mock_socket.set_receive_data([bytes(corrupt_frame) + good_frame])
+
+    with rct_reader.RctReader('localhost', "8899") as reader:
+        with pytest.raises(FrameCRCMismatch):
+            reader.recv_frame(1)
+        # the corrupt frame is skipped, the good one is parsed from the bytes already received
+        responses = reader.recv_frame(1)
+
+    assert decode_value(bat_cycles_objinfo.response_data_type, responses[0].payload) == 2
+
+
+def test_make_line_matches_point():
+    fields = {
+        'power': 123.5,
+        'soc': 1.0,
+        'cycles': 42,
+        'island': False,
+        'serial': 'a "b" \\c',
+        'broken': float('nan'),
+    }
+    point = Point('pv').tag('inverter', 'RCT').time(1700000000, WritePrecision.S)
+    for key, value in fields.items():
+        point.field(key, value)
+    assert pv_reader.make_line(fields, 1700000000) == point.to_line_protocol()
+    assert pv_reader.make_line({'broken': float('inf')}, 1700000000) is None